@@ -1,13 +1,15 @@
 from fastmcp import FastMCP
 import aiosqlite
+import asyncio
+import json
+import logging
 import os
-import sys
-from datetime import datetime, date
+from contextlib import asynccontextmanager
+from datetime import date
+from pathlib import Path
+from typing import NotRequired, TypedDict
 
-# -------------------------------------------------
-# MCP SERVER
-# -------------------------------------------------
-mcp = FastMCP(name="expense-mcp-async")
+log = logging.getLogger("expense-mcp")
 
 # -------------------------------------------------
 # DATABASE PATH (PERSISTENT)
@@ -15,26 +17,391 @@ mcp = FastMCP(name="expense-mcp-async")
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_PATH = os.path.join(BASE_DIR, "expenses.db")
 
+READER_COUNT = 4
+
+# Page size bounds for list_expenses
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+# Upper bound on writes committed together by the writer loop
+WRITE_BATCH_MAX = 256
+
+# Per-connection tuning, applied to every pooled handle.
+# journal_mode is persistent in the file, so only the writer sets it.
+CONNECTION_PRAGMAS = """
+    PRAGMA synchronous=NORMAL;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA cache_size=-64000;
+    PRAGMA mmap_size=268435456;
+"""
+
+# sqlite3 keeps a per-connection cache of prepared statements keyed by the
+# exact SQL text, so every query lives in a constant and is reused verbatim.
+CACHED_STATEMENTS = 256
+
+# created_at is filled in by the column default
+SQL_INSERT = """
+    INSERT INTO expenses (amount, category_id, sub_category_id, expense_date)
+    VALUES (?, ?, ?, ?)
+"""
+
+# All 8 list_expenses filter shapes, keyed by a bitmask of active filters
+# (bit0=category, bit1=start_date, bit2=end_date)
+LIST_FILTERS = ("e.category_id = ?", "e.expense_date >= ?", "e.expense_date <= ?")
+
+def _list_sql(mask: int) -> str:
+    where = " AND ".join(f for bit, f in enumerate(LIST_FILTERS) if mask & (1 << bit))
+    return f"""
+    SELECT e.id, e.amount, c.name AS category, COALESCE(s.name, '') AS sub_category,
+           e.expense_date AS date, e.created_at
+    FROM expenses e
+    JOIN categories c ON c.id = e.category_id
+    LEFT JOIN sub_categories s ON s.id = e.sub_category_id
+    {"WHERE " + where if where else ""}
+    ORDER BY e.expense_date DESC, e.id DESC
+    LIMIT ? OFFSET ?
+"""
+
+LIST_SQL = {mask: _list_sql(mask) for mask in range(1 << len(LIST_FILTERS))}
+
+SQL_DELETE = "DELETE FROM expenses WHERE id = ?"
+
+# All 15 UPDATE shapes, keyed by a bitmask of the columns being set
+# (bit0=amount, bit1=category, bit2=sub_category, bit3=expense_date).
+# UPDATE_FIELDS keeps the tool-facing names reported back to callers.
+UPDATE_COLUMNS = ("amount", "category_id", "sub_category_id", "expense_date")
+UPDATE_NAMES = ("amount", "category", "sub_category", "expense_date")
+
+def _update_set(names: tuple[str, ...], mask: int) -> tuple[str, ...]:
+    return tuple(f"{name} = ?" for bit, name in enumerate(names) if mask & (1 << bit))
+
+UPDATE_FIELDS = {
+    mask: _update_set(UPDATE_NAMES, mask)
+    for mask in range(1, 1 << len(UPDATE_COLUMNS))
+}
+UPDATE_SQL = {
+    mask: f"UPDATE expenses SET {', '.join(_update_set(UPDATE_COLUMNS, mask))} WHERE id = ?"
+    for mask in UPDATE_FIELDS
+}
+
+SQL_SUMMARY = """
+    SELECT SUM(amount)
+    FROM expenses
+    WHERE expense_date BETWEEN ? AND ?
+"""
+
+# -------------------------------------------------
+# CONNECTION POOL (1 WRITER, N READERS)
+# -------------------------------------------------
+class SqlitePool:
+    def __init__(self, path: str, readers: int = READER_COUNT):
+        self.path = path
+        self.readers = readers
+        self._writer: asyncio.Queue[aiosqlite.Connection] = asyncio.Queue(maxsize=1)
+        self._reader: asyncio.Queue[aiosqlite.Connection] = asyncio.Queue(maxsize=readers)
+        self._conns: list[aiosqlite.Connection] = []
+        self._pending: asyncio.Queue[tuple[str, tuple, asyncio.Future] | None] = asyncio.Queue()
+        self._writer_task: asyncio.Task | None = None
+
+    async def open_writer(self) -> aiosqlite.Connection:
+        db = await aiosqlite.connect(self.path, cached_statements=CACHED_STATEMENTS)
+        # Enable WAL so readers don't block the writer
+        await db.execute("PRAGMA journal_mode=WAL;")
+        await db.executescript(CONNECTION_PRAGMAS)
+        self._conns.append(db)
+        self._writer.put_nowait(db)
+        return db
+
+    async def open_readers(self):
+        # Read-only handles; the database file must already exist.
+        # as_uri() percent-encodes characters such as ?, # and % in the path.
+        ro_uri = Path(self.path).resolve().as_uri() + "?mode=ro"
+        for _ in range(self.readers):
+            db = await aiosqlite.connect(ro_uri, uri=True, cached_statements=CACHED_STATEMENTS)
+            await db.executescript(CONNECTION_PRAGMAS)
+            # Rows come back keyed by column name, ready for dict(row)
+            db.row_factory = aiosqlite.Row
+            self._conns.append(db)
+            self._reader.put_nowait(db)
+
+    @asynccontextmanager
+    async def acquire_read(self):
+        db = await self._reader.get()
+        try:
+            yield db
+        finally:
+            self._reader.put_nowait(db)
+
+    @asynccontextmanager
+    async def acquire_write(self):
+        db = await self._writer.get()
+        try:
+            yield db
+        except BaseException:
+            # Error or cancellation (client disconnect, notifications/cancelled)
+            # between BEGIN and COMMIT: never hand the writer back mid-transaction.
+            # The rollback is queued behind any statement still running on the
+            # connection's thread, and shielded from a second cancellation.
+            await self._rollback(db)
+            raise
+        else:
+            if db.in_transaction:
+                await self._rollback(db)
+        finally:
+            self._writer.put_nowait(db)
+
+    async def _rollback(self, db: aiosqlite.Connection):
+        try:
+            await asyncio.shield(db.rollback())
+        except Exception:
+            log.exception("Rollback of an abandoned write transaction failed")
+
+    # ---------------------------------------------
+    # WRITE COALESCING
+    # ---------------------------------------------
+    def start_writer_loop(self):
+        self._writer_task = asyncio.create_task(self._writer_loop())
+
+    # Queue one write and wait for its batch to commit -> (lastrowid, rowcount)
+    async def submit(self, sql: str, params: tuple) -> tuple[int | None, int]:
+        fut = asyncio.get_running_loop().create_future()
+        await self._pending.put((sql, params, fut))
+        return await fut
+
+    async def _writer_loop(self):
+        while True:
+            item = await self._pending.get()
+            if item is None:
+                return
+            # Let callers scheduled alongside this one enqueue before flushing
+            await asyncio.sleep(0)
+
+            batch = [item]
+            stop = False
+            while len(batch) < WRITE_BATCH_MAX and not self._pending.empty():
+                item = self._pending.get_nowait()
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+
+            try:
+                await self._flush(batch)
+            except Exception as e:
+                # Keep the loop alive; a dead writer task would leave every
+                # later submit() waiting forever
+                log.exception("Write batch failed")
+                self._fail(batch, e)
+            if stop:
+                return
+
+    def _fail(self, batch: list[tuple[str, tuple, asyncio.Future]], error: Exception):
+        for _, _, fut in batch:
+            if not fut.done():
+                fut.set_exception(error)
+
+    async def _flush(self, batch: list[tuple[str, tuple, asyncio.Future]]):
+        # One transaction (and one WAL sync) per batch instead of per write.
+        # A failed BEGIN or COMMIT propagates out of acquire_write(), which rolls
+        # back whatever transaction is open, and then fails the whole batch.
+        results = []
+        try:
+            async with self.acquire_write() as db:
+                if db.in_transaction:
+                    await self._rollback(db)
+                await db.execute("BEGIN")
+                # Any per-statement failure (sqlite3.Error, OverflowError on
+                # bind, ...) fails only its own caller
+                for sql, params, fut in batch:
+                    try:
+                        cursor = await db.execute(sql, params)
+                        results.append((fut, (cursor.lastrowid, cursor.rowcount)))
+                    except Exception as e:
+                        results.append((fut, e))
+                await db.commit()
+        except Exception as e:
+            self._fail(batch, e)
+            return
+
+        for fut, result in results:
+            if fut.done():
+                continue
+            if isinstance(result, Exception):
+                fut.set_exception(result)
+            else:
+                fut.set_result(result)
+
+    async def close(self):
+        if self._writer_task is not None:
+            # Sentinel lets already-queued writes commit before shutdown
+            await self._pending.put(None)
+            await self._writer_task
+            self._writer_task = None
+        for db in self._conns:
+            await db.close()
+        self._conns.clear()
+
+# Shared pool, opened once by init_db() and reused by every tool
+POOL: SqlitePool | None = None
+
+# -------------------------------------------------
+# CATEGORY LOOKUP TABLES
+# -------------------------------------------------
+class NameTable:
+    # Maps names to ids in a (id, name UNIQUE) table, caching hits in memory.
+    # Names are never deleted, so cached ids stay valid for the pool's lifetime.
+    def __init__(self, table: str):
+        self.sql_insert = f"INSERT OR IGNORE INTO {table} (name) VALUES (?)"
+        self.sql_select = f"SELECT id FROM {table} WHERE name = ?"
+        self.sql_select_many = (
+            f"SELECT name, id FROM {table} WHERE name IN (SELECT value FROM json_each(?))"
+        )
+        # Stores the name only while the given expense row exists
+        self.sql_insert_for_expense = (
+            f"INSERT OR IGNORE INTO {table} (name) "
+            f"SELECT ? WHERE EXISTS (SELECT 1 FROM expenses WHERE id = ?)"
+        )
+        self.ids: dict[str, int] = {}
+
+    # Read-only lookup; None when the name has never been stored
+    async def lookup(self, name: str) -> int | None:
+        if name in self.ids:
+            return self.ids[name]
+
+        async with POOL.acquire_read() as db:
+            cursor = await db.execute(self.sql_select, (name,))
+            row = await cursor.fetchone()
+        if row is not None:
+            self.ids[name] = row[0]
+            return row[0]
+        return None
+
+    # Lookup first so names that already exist never cost a write
+    async def resolve(self, name: str) -> int:
+        name_id = await self.lookup(name)
+        if name_id is not None:
+            return name_id
+
+        await POOL.submit(self.sql_insert, (name,))
+        return await self.lookup(name)
+
+    # Like resolve(), but a new name is only stored if expense_id exists;
+    # None means the expense is missing
+    async def resolve_for_expense(self, name: str, expense_id: int) -> int | None:
+        name_id = await self.lookup(name)
+        if name_id is not None:
+            return name_id
+
+        await POOL.submit(self.sql_insert_for_expense, (name, expense_id))
+        return await self.lookup(name)
+
+    # Bulk resolve inside the caller's open transaction on the writer: one
+    # executemany insert plus one select for every uncached name. Ids are not
+    # cached here, since the transaction may still roll back.
+    async def resolve_many(self, db: aiosqlite.Connection, names: set[str]) -> dict[str, int]:
+        ids = {name: self.ids[name] for name in names if name in self.ids}
+        missing = [name for name in names if name not in ids]
+        if missing:
+            await db.executemany(self.sql_insert, [(name,) for name in missing])
+            cursor = await db.execute(self.sql_select_many, (json.dumps(missing),))
+            ids.update(await cursor.fetchall())
+        return ids
+
+CATEGORIES = NameTable("categories")
+SUB_CATEGORIES = NameTable("sub_categories")
+
+# Rewrites a pre-normalization expenses table (TEXT category/sub_category)
+# into the id-based layout, keeping ids and timestamps.
+MIGRATE_TEXT_CATEGORIES = """
+    BEGIN;
+    INSERT OR IGNORE INTO categories (name)
+        SELECT DISTINCT category FROM expenses;
+    INSERT OR IGNORE INTO sub_categories (name)
+        SELECT DISTINCT sub_category FROM expenses
+        WHERE sub_category IS NOT NULL AND sub_category <> '';
+    ALTER TABLE expenses RENAME TO expenses_legacy;
+    {create_expenses};
+    INSERT INTO expenses (id, amount, category_id, sub_category_id, expense_date, created_at)
+        SELECT o.id, o.amount, c.id, s.id, o.expense_date, o.created_at
+        FROM expenses_legacy o
+        JOIN categories c ON c.name = o.category
+        LEFT JOIN sub_categories s ON s.name = o.sub_category;
+    DELETE FROM sqlite_sequence WHERE name = 'expenses';
+    UPDATE sqlite_sequence SET name = 'expenses' WHERE name = 'expenses_legacy';
+    DROP TABLE expenses_legacy;
+    COMMIT;
+"""
+
 # -------------------------------------------------
 # INIT DATABASE (ASYNC)
 # -------------------------------------------------
 async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        # Enable WAL for concurrency
-        await db.execute("PRAGMA journal_mode=WAL;")
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS expenses (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                amount REAL NOT NULL,
-                category TEXT NOT NULL,
-                sub_category TEXT DEFAULT '',
-                expense_date TEXT NOT NULL,
-                created_at TEXT NOT NULL
-            )
-        """)
-        await db.commit()
+    global POOL
+    POOL = SqlitePool(DB_PATH)
+    CATEGORIES.ids.clear()
+    SUB_CATEGORIES.ids.clear()
+    db = await POOL.open_writer()
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS categories (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE
+        )
+    """)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS sub_categories (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE
+        )
+    """)
+    create_expenses = """
+        CREATE TABLE IF NOT EXISTS expenses (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            amount REAL NOT NULL,
+            category_id INTEGER NOT NULL REFERENCES categories(id),
+            sub_category_id INTEGER REFERENCES sub_categories(id),
+            expense_date TEXT NOT NULL,
+            created_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ', 'now'))
+        )
+    """
+    cursor = await db.execute("PRAGMA table_info(expenses)")
+    columns = {row[1] for row in await cursor.fetchall()}
+    if "category" in columns:
+        await db.executescript(MIGRATE_TEXT_CATEGORIES.format(create_expenses=create_expenses))
+    else:
+        await db.execute(create_expenses)
+    # Covers the date-range SUM in summarize_expenses and gives
+    # list_expenses its ORDER BY expense_date (scanned in reverse)
+    await db.execute("""
+        CREATE INDEX IF NOT EXISTS idx_expenses_date_amount
+        ON expenses (expense_date, amount)
+    """)
+    await db.commit()
+    await POOL.open_readers()
+    POOL.start_writer_loop()
+
+    log.info("[INIT] DB initialized at %s", DB_PATH)
+    return POOL
+
+async def close_db():
+    global POOL
+    if POOL is not None:
+        await POOL.close()
+        POOL = None
 
-    print(f"[INIT] DB initialized at {DB_PATH}", file=sys.stderr)
+# Runs on the server's own event loop; the pool is also exposed on the
+# lifespan context for hosts that mount this server
+@asynccontextmanager
+async def db_lifespan(server):
+    pool = await init_db()
+    try:
+        yield {"pool": pool}
+    finally:
+        await close_db()
+
+# -------------------------------------------------
+# MCP SERVER
+# -------------------------------------------------
+mcp = FastMCP(name="expense-mcp-async", lifespan=db_lifespan)
 
 # -------------------------------------------------
 # ADD EXPENSE
@@ -49,19 +416,15 @@ async def add_expense(
     if expense_date is None:
         expense_date = date.today().isoformat()
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("""
-            INSERT INTO expenses (amount, category, sub_category, expense_date, created_at)
-            VALUES (?, ?, ?, ?, ?)
-        """, (
-            amount,
-            category.lower(),
-            sub_category.lower(),
-            expense_date,
-            datetime.utcnow().isoformat()
-        ))
-        await db.commit()
-        expense_id = cursor.lastrowid
+    category_id = await CATEGORIES.resolve(category.lower())
+    sub_category_id = await SUB_CATEGORIES.resolve(sub_category.lower()) if sub_category else None
+
+    expense_id, _ = await POOL.submit(SQL_INSERT, (
+        amount,
+        category_id,
+        sub_category_id,
+        expense_date
+    ))
 
     return {
         "status": "success",
@@ -72,31 +435,93 @@ async def add_expense(
         "date": expense_date
     }
 
+# -------------------------------------------------
+# ADD EXPENSES (BULK)
+# -------------------------------------------------
+# Typed so FastMCP validates every item against the schema before the tool runs
+class ExpenseItem(TypedDict):
+    amount: float
+    category: str
+    sub_category: NotRequired[str]
+    expense_date: NotRequired[str | None]
+
+@mcp.tool()
+async def add_expenses(items: list[ExpenseItem]) -> dict:
+    if not items:
+        return {"status": "success", "inserted": 0}
+
+    today = date.today().isoformat()
+    categories = [item["category"].lower() for item in items]
+    sub_categories = [(item.get("sub_category") or "").lower() for item in items]
+
+    # Names, ids and expenses all land in one transaction with one commit
+    # (acquire_write rolls back on any error or cancellation before COMMIT)
+    async with POOL.acquire_write() as db:
+        await db.execute("BEGIN")
+        category_ids = await CATEGORIES.resolve_many(db, set(categories))
+        sub_category_ids = await SUB_CATEGORIES.resolve_many(db, set(filter(None, sub_categories)))
+        await db.executemany(SQL_INSERT, [
+            (
+                item["amount"],
+                category_ids[category],
+                sub_category_ids[sub_category] if sub_category else None,
+                item.get("expense_date") or today
+            )
+            for item, category, sub_category in zip(items, categories, sub_categories)
+        ])
+        await db.commit()
+
+    CATEGORIES.ids.update(category_ids)
+    SUB_CATEGORIES.ids.update(sub_category_ids)
+
+    return {"status": "success", "inserted": len(items)}
+
 # -------------------------------------------------
 # LIST EXPENSES
 # -------------------------------------------------
 @mcp.tool()
-async def list_expenses() -> dict:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("""
-            SELECT id, amount, category, sub_category, expense_date, created_at
-            FROM expenses
-            ORDER BY expense_date DESC
-        """)
-        rows = await cursor.fetchall()
+async def list_expenses(
+    category: str | None = None,
+    start_date: str | None = None,
+    end_date: str | None = None,
+    limit: int = DEFAULT_PAGE_SIZE,
+    offset: int = 0
+) -> dict:
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    offset = max(0, offset)
+
+    expenses = []
+    truncated = False
+
+    params = []
+    if category is not None:
+        category_id = await CATEGORIES.lookup(category.lower())
+        if category_id is None:
+            return {"count": 0, "offset": offset, "next_offset": None, "truncated": False, "expenses": []}
+        params.append(category_id)
+    if start_date is not None:
+        params.append(start_date)
+    if end_date is not None:
+        params.append(end_date)
+    params += [limit + 1, offset]
+
+    mask = (category is not None) | (start_date is not None) << 1 | (end_date is not None) << 2
+
+    async with POOL.acquire_read() as db:
+        # Ask for one extra row to know whether another page exists
+        async with db.execute(LIST_SQL[mask], params) as cursor:
+            async for r in cursor:
+                if len(expenses) == limit:
+                    truncated = True
+                    break
+                expenses.append(dict(r))
 
     return {
-        "count": len(rows),
-        "expenses": [
-            {
-                "id": r[0],
-                "amount": r[1],
-                "category": r[2],
-                "sub_category": r[3],
-                "date": r[4],
-                "created_at": r[5]
-            } for r in rows
-        ]
+        "count": len(expenses),
+        "offset": offset,
+        "next_offset": offset + len(expenses) if truncated else None,
+        "truncated": truncated,
+        "expenses": expenses
     }
 
 # -------------------------------------------------
@@ -111,41 +536,50 @@ async def update_expense(
     expense_date: str | None = None
 ) -> dict:
 
-    fields = []
-    values = []
+    mask = (
+        (amount is not None)
+        | (category is not None) << 1
+        | (sub_category is not None) << 2
+        | (expense_date is not None) << 3
+    )
+    if not mask:
+        return {"status": "error", "message": "No fields to update"}
 
+    not_found = {"status": "error", "message": f"Expense {expense_id} not found"}
+
+    values = []
     if amount is not None:
-        fields.append("amount = ?")
         values.append(amount)
     if category is not None:
-        fields.append("category = ?")
-        values.append(category.lower())
+        category_id = await CATEGORIES.resolve_for_expense(category.lower(), expense_id)
+        if category_id is None:
+            return not_found
+        values.append(category_id)
     if sub_category is not None:
-        fields.append("sub_category = ?")
-        values.append(sub_category.lower())
+        sub_category_id = None
+        if sub_category:
+            sub_category_id = await SUB_CATEGORIES.resolve_for_expense(sub_category.lower(), expense_id)
+            if sub_category_id is None:
+                return not_found
+        values.append(sub_category_id)
     if expense_date is not None:
-        fields.append("expense_date = ?")
         values.append(expense_date)
-
-    if not fields:
-        return {"status": "error", "message": "No fields to update"}
-
     values.append(expense_id)
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(f"UPDATE expenses SET {', '.join(fields)} WHERE id = ?", values)
-        await db.commit()
+    _, rowcount = await POOL.submit(UPDATE_SQL[mask], tuple(values))
+    if rowcount == 0:
+        return not_found
 
-    return {"status": "success", "updated_fields": fields}
+    return {"status": "success", "updated_fields": list(UPDATE_FIELDS[mask])}
 
 # -------------------------------------------------
 # DELETE EXPENSE
 # -------------------------------------------------
 @mcp.tool()
 async def delete_expense(expense_id: int) -> dict:
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("DELETE FROM expenses WHERE id = ?", (expense_id,))
-        await db.commit()
+    _, rowcount = await POOL.submit(SQL_DELETE, (expense_id,))
+    if rowcount == 0:
+        return {"status": "error", "message": f"Expense {expense_id} not found"}
 
     return {"status": "success", "deleted_id": expense_id}
 
@@ -154,12 +588,8 @@ async def delete_expense(expense_id: int) -> dict:
 # -------------------------------------------------
 @mcp.tool()
 async def summarize_expenses(start_date: str, end_date: str) -> dict:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("""
-            SELECT SUM(amount)
-            FROM expenses
-            WHERE expense_date BETWEEN ? AND ?
-        """, (start_date, end_date))
+    async with POOL.acquire_read() as db:
+        cursor = await db.execute(SQL_SUMMARY, (start_date, end_date))
         total = (await cursor.fetchone())[0] or 0.0
 
     return {
@@ -172,10 +602,9 @@ async def summarize_expenses(start_date: str, end_date: str) -> dict:
 # RUN SERVER
 # -------------------------------------------------
 if __name__ == "__main__":
-    # Use `startup=init_db` instead of asyncio.run()
+    # init_db() / close_db() run inside the server lifespan (db_lifespan)
     mcp.run(
         transport="http",
         host="0.0.0.0",
-        port=8000,
-        startup=init_db
+        port=8000
     )